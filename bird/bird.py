@@ -1,23 +1,42 @@
 from dotenv import load_dotenv
 import os
-from mastodon import Mastodon
-from openai import OpenAI
+from mastodon import Mastodon, MastodonNetworkError, MastodonRatelimitError, MastodonServerError
+import openai
+from openai import AsyncOpenAI
+import httpx
+from tenacity import retry, stop_after_attempt, wait_exponential_jitter, retry_if_exception, before_sleep_log
 import requests
+from requests.adapters import HTTPAdapter
+import asyncio
+import tempfile
 from io import BytesIO
-import time
-import subprocess
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
+import signal
+from email.message import EmailMessage
 import sys
 import base64
 from datetime import datetime, timedelta
 import csv
+from collections import defaultdict
 import random
+import logging
+import logging.handlers
+import queue
+import atexit
 
 load_dotenv()
 
+# Log through a queue so writing to the console happens on the listener thread instead of blocking the event loop
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "INFO"),
+    format="%(asctime)s %(levelname)s %(message)s",
+    handlers=[logging.handlers.QueueHandler(log_queue)]
+)
+logger = logging.getLogger(__name__)
+
 ERROR_FILE = "birdbot_error_time.txt"
 
 # File paths for prompts and other data
@@ -26,6 +45,15 @@ PROMPT_FILE = 'prompt.txt'
 PROMPT_BASE_FILE = 'prompt_base.txt'
 JOBS_FILE = 'jobs.txt'
 
+# Set DEBUG to write each final prompt out to PROMPT_FILE
+DEBUG = os.getenv('DEBUG', '').lower() in ('1', 'true', 'yes')
+
+# Random source for job and holiday picks
+_rng = random.Random()
+
+# Downloaded images are buffered in memory up to this size before spilling to disk
+IMAGE_SPOOL_SIZE = 4 * 1024 * 1024
+
 # Mastodon API credentials
 MASTODON_BASE_URL = os.getenv('MASTODON_BASE_URL')
 MASTODON_ACCESS_TOKEN = os.getenv('MASTODON_ACCESS_TOKEN')
@@ -34,21 +62,68 @@ MASTODON_ACCESS_TOKEN = os.getenv('MASTODON_ACCESS_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
 # Set up Mastodon API client
-print("[INFO] Setting up Mastodon API client...")
+logger.info("Setting up Mastodon API client...")
+# Mastodon.py is requests-based, so give it its own small pool to the one instance
+mastodon_session = requests.Session()
+mastodon_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
 mastodon = Mastodon(
     access_token=MASTODON_ACCESS_TOKEN,
-    api_base_url=MASTODON_BASE_URL
+    api_base_url=MASTODON_BASE_URL,
+    session=mastodon_session,
+    ratelimit_method='pace',
+    request_timeout=60
 )
 
 #Grab email address from environment variable
 EMAIL_ADDRESS = os.getenv('EMAIL_ADDRESS')
 
+# One HTTP client shared by the OpenAI SDK and image downloads, with long-lived keep-alive connections.
+# Image generation can take minutes, so only the read timeout is relaxed.
+http_client = httpx.AsyncClient(
+    limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300.0),
+    follow_redirects=True,
+    timeout=httpx.Timeout(60.0, read=300.0)
+)
+
 # Set up OpenAI API client
-print("[INFO] Setting up OpenAI API client...")
-client = OpenAI(api_key=OPENAI_API_KEY)
+logger.info("Setting up OpenAI API client...")
+# Retries are handled by api_retry/generation_retry below rather than the SDK's own
+client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_client, max_retries=0)
+
+# Transient API failures are retried in place with backoff before failing the whole attempt
+TRANSIENT_ERRORS = (
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    httpx.HTTPError,
+    MastodonNetworkError,
+    MastodonRatelimitError,
+    MastodonServerError,
+)
+
+def is_transient(exc):
+    """Check whether an API failure is worth retrying in place."""
+    # A 429 for an exhausted quota won't clear up by waiting
+    if isinstance(exc, openai.RateLimitError) and exc.code == 'insufficient_quota':
+        return False
+    return isinstance(exc, TRANSIENT_ERRORS)
+
+def is_transient_generation(exc):
+    """Check whether an image generation failure is worth retrying in place."""
+    # A timed-out generation may still have run and been billed, so don't start another
+    return is_transient(exc) and not isinstance(exc, openai.APITimeoutError)
+
+RETRY_POLICY = dict(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=60),
+    before_sleep=before_sleep_log(logger, logging.WARNING),
+    reraise=True
+)
+api_retry = retry(retry=retry_if_exception(is_transient), **RETRY_POLICY)
+generation_retry = retry(retry=retry_if_exception(is_transient_generation), **RETRY_POLICY)
 
-def time_until_next_run(target_hour=9):
-    """Calculate the time until the next target hour (9 AM by default)."""
+def next_run_time(target_hour=9):
+    """Calculate the datetime of the next target hour (9 AM by default)."""
     now = datetime.now()
     target_time = now.replace(hour=target_hour, minute=0, second=0, microsecond=0)
 
@@ -56,172 +131,261 @@ def time_until_next_run(target_hour=9):
     if now >= target_time:
         target_time += timedelta(days=1)
 
-    return (target_time - now).total_seconds()
+    return target_time
 
-def should_retry():
-    """Check if the script should retry based on last error time."""
-    if os.path.exists(ERROR_FILE):
+def seconds_until(target_time):
+    """Calculate the number of seconds from now until the given datetime."""
+    return (target_time - datetime.now()).total_seconds()
+
+def load_last_error():
+    """Read the last error time from the error file, or None if there isn't a usable one."""
+    try:
         with open(ERROR_FILE, 'r') as f:
             content = f.read().strip()
-            if not content:
-                print("[DEBUG] Error file is empty. Assuming no recent error.")
-                return True
-            try:
-                last_error_time = datetime.fromisoformat(content)
-                if datetime.now() < last_error_time + timedelta(hours=24):
-                    print("[INFO] Pausing for 24 hours to prevent continuous retries...")
-                    return False
-            except ValueError:
-                print(f"[ERROR] Invalid timestamp in error file: {content}. Ignoring and proceeding.")
-                return True
+    except FileNotFoundError:
+        return None
+
+    if not content:
+        logger.debug("Error file is empty. Assuming no recent error.")
+        return None
+    try:
+        return datetime.fromisoformat(content)
+    except ValueError:
+        logger.error("Invalid timestamp in error file: %s. Ignoring and proceeding.", content)
+        return None
+
+# Read the error file once at startup; record_error keeps this and the file in sync afterwards
+_last_error = load_last_error()
+
+def should_retry():
+    """Check if the script should retry based on last error time."""
+    if _last_error is not None and datetime.now() < _last_error + timedelta(hours=24):
+        logger.info("Pausing for 24 hours to prevent continuous retries...")
+        return False
     return True
 
 def record_error():
     """Record the current time as the last error time."""
+    global _last_error
+    _last_error = datetime.now()
     with open(ERROR_FILE, 'w') as f:
-        f.write(datetime.now().isoformat())
+        f.write(_last_error.isoformat())
 
-def send_email(subject: str, body: str, image_bytes: bytes, to_email: str):
-    """Send an email with the image attached using msmtp."""
+def build_email(subject: str, body: str, image_bytes: bytes, to_email: str) -> bytes:
+    """Render the email with the image attached."""
     # Create the email message
-    msg = MIMEMultipart('related')
+    msg = EmailMessage()
     msg['To'] = to_email
     msg['Subject'] = subject
 
     # Create a plain text part with a reference to the inline image
     text_body = f"{body}\n\nImage is attached."
-    msg.attach(MIMEText(text_body, 'plain'))
-
-    # Create a MIME part for the image
-    image_part = MIMEBase('image', 'png')
-    image_part.set_payload(image_bytes)
-    encoders.encode_base64(image_part)
-    image_part.add_header('Content-ID', '<image1>')
-    image_part.add_header('Content-Disposition', 'inline; filename="image.png"')
-
-    # Attach the image to the message
-    msg.attach(image_part)
-
-    # Send the email using msmtp
-    try:
-        process = subprocess.Popen(
-            ["/usr/bin/msmtp", "--debug", "--from=default", to_email],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        stdout, stderr = process.communicate(msg.as_string().encode('utf-8'))
-
-        if process.returncode != 0:
-            print(f"[ERROR] Failed to send email: {stderr.decode()}")
-        else:
-            print(f"[INFO] Email sent successfully to {to_email}")
-    except Exception as e:
-        print(f"[ERROR] An error occurred while sending the email: {e}")
-
-def generate_image(prompt: str) -> bytes:
-    """Generate an image using OpenAI from the given prompt."""
-    print(f"[INFO] Generating image with prompt: {prompt}")
-    response = client.images.generate(
+    msg.set_content(text_body)
+
+    # Attach the image inline, alongside the text in a multipart/related message
+    msg.add_related(image_bytes, maintype='image', subtype='png', cid='<image1>', disposition='inline', filename='image.png')
+
+    return msg.as_bytes()
+
+async def send_email(msg_bytes: bytes, to_email: str, attempts: int = 3):
+    """Send a rendered email using msmtp, resending the same message if msmtp fails."""
+    for attempt in range(attempts):
+        # Send the email using msmtp
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "/usr/bin/msmtp", "--debug", "--from=default", to_email,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
+            )
+            stdout, stderr = await process.communicate(msg_bytes)
+        except Exception as e:
+            logger.error("An error occurred while sending the email: %s", e)
+            return
+
+        if process.returncode == 0:
+            logger.info("Email sent successfully to %s", to_email)
+            return
+
+        logger.error("Failed to send email (attempt %s of %s): %s", attempt + 1, attempts, stderr.decode())
+        if attempt < attempts - 1:
+            await asyncio.sleep(30)
+
+async def generate_images(prompt: str, n: int = 1) -> list:
+    """Generate n images using OpenAI from the given prompt in a single request."""
+    logger.info("Generating %s image(s) with prompt: %s", n, prompt)
+    response = await request_images(prompt, n)
+    return await asyncio.gather(*(fetch_image(item) for item in response.data))
+
+@generation_retry
+async def request_images(prompt: str, n: int):
+    """Call the Images API, retrying transient failures."""
+    return await client.images.generate(
         model="gpt-image-1-mini",
         prompt=prompt,
         size="auto",
-        n=1,
+        n=n,
     )
 
-    item = response.data[0]
-
+async def fetch_image(item):
+    """Turn one item of an image generation response into the decoded bytes, or a downloaded file rewound to the start."""
     # Preferred path for GPT Image models
     if hasattr(item, "b64_json") and item.b64_json:
-        print("[INFO] Received base64 image payload.")
+        logger.info("Received base64 image payload.")
         return base64.b64decode(item.b64_json)
 
     # Fallback (should not happen, but safe)
     if hasattr(item, "url") and item.url:
-        print(f"[INFO] Received URL payload. Downloading from {item.url}...")
-        r = requests.get(item.url)
-        r.raise_for_status()
-        return r.content
+        logger.info("Received URL payload. Downloading from %s...", item.url)
+        return await download_image(item.url)
 
     raise RuntimeError("No image data returned (neither b64_json nor url).")
 
-def post_image_to_mastodon(image_bytes: bytes, status_text: str, alt_text: str):
+@api_retry
+async def download_image(url: str) -> tempfile.SpooledTemporaryFile:
+    """Stream an image URL into a file rewound to the start, retrying transient failures."""
+    image_file = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_SIZE)
+    try:
+        async with http_client.stream("GET", url) as r:
+            r.raise_for_status()
+            async for chunk in r.aiter_bytes(65536):
+                image_file.write(chunk)
+    except BaseException:
+        image_file.close()
+        raise
+    image_file.seek(0)
+    return image_file
+
+def post_image_to_mastodon(image_file, status_text: str, alt_text: str):
     """Post the generated image to Mastodon with alt text and status."""
-    print("[INFO] Uploading image to Mastodon...")
-    media = mastodon.media_post(media_file=BytesIO(image_bytes), mime_type="image/png", description=alt_text)
-    print("[INFO] Image uploaded. Posting status...")
+    logger.info("Uploading image to Mastodon...")
+    media = upload_media(image_file, alt_text)
+    logger.info("Image uploaded. Posting status...")
     mastodon.status_post(status=status_text, media_ids=[media['id']])
-    print("[INFO] Status posted successfully.")
+    logger.info("Status posted successfully.")
+
+@api_retry
+def upload_media(image_file, alt_text: str):
+    """Upload the image to Mastodon from the start of the file, retrying transient failures."""
+    image_file.seek(0)
+    return mastodon.media_post(media_file=image_file, mime_type="image/png", description=alt_text)
+
+async def prewarm():
+    """Open connections to OpenAI and Mastodon ahead of the run so the real requests skip the TLS handshake."""
+    logger.info("Pre-warming API connections...")
+    results = await asyncio.gather(
+        http_client.head(str(client.base_url)),
+        asyncio.to_thread(mastodon.instance),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.debug("Pre-warm request failed, continuing anyway: %s", result)
 
 def get_random_job():
-    if not os.path.exists(JOBS_FILE):
-        print(f"[ERROR] Jobs file '{JOBS_FILE}' not found.")
+    try:
+        with open(JOBS_FILE, 'r') as f:
+            jobs = [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        logger.error("Jobs file '%s' not found.", JOBS_FILE)
         sys.exit(1)
-    with open(JOBS_FILE, 'r') as f:
-        jobs = [line.strip() for line in f if line.strip()]
-    return random.choice(jobs)
+    return _rng.choice(jobs)
 
-def generate_prompt():
-    """Generate a prompt by combining the base prompt with a random job and any matching holiday."""
-    today = datetime.now().strftime('%-m/%-d/%Y')
-    print(f"[INFO] Today's date: {today}")
+def load_holidays():
+    """Read the holidays file once and index its rows by date."""
+    index = defaultdict(list)
+    try:
+        with open(HOLIDAYS_FILE, 'r', newline='') as f:
+            for row in csv.DictReader(f):
+                index[row['Date']].append(row)
+    except FileNotFoundError:
+        pass
+    return index
 
-    if not os.path.exists(PROMPT_BASE_FILE):
-        print(f"[ERROR] Base prompt file '{PROMPT_BASE_FILE}' not found.")
+# The holidays file is static at runtime, so parse it once at startup
+HOLIDAY_INDEX = load_holidays()
+
+def load_base_prompt():
+    """Read the base prompt template."""
+    try:
+        with open(PROMPT_BASE_FILE, 'r') as f:
+            base_prompt = f.read().strip()
+    except FileNotFoundError:
+        logger.error("Base prompt file '%s' not found.", PROMPT_BASE_FILE)
         sys.exit(1)
+    logger.info("Base prompt read from '%s'", PROMPT_BASE_FILE)
+    return base_prompt
 
-    with open(PROMPT_BASE_FILE, 'r') as f:
-        base_prompt = f.read().strip()
-    print(f"[INFO] Base prompt read from '{PROMPT_BASE_FILE}'")
+BASE_PROMPT = load_base_prompt()
+
+def generate_prompt():
+    """Generate a prompt by combining the base prompt with a random job and any matching holiday."""
+    # Matches the M/D/YYYY dates in the holidays file without relying on GNU-only strftime flags
+    now = datetime.now()
+    today = f"{now.month}/{now.day}/{now.year}"
+    logger.info("Today's date: %s", today)
 
     # Job substitution
     job = get_random_job()
-    base_prompt = base_prompt.replace('{job}', job)
-    print(f"[INFO] Random job selected: {job}")
+    base_prompt = BASE_PROMPT.replace('{job}', job)
+    logger.info("Random job selected: %s", job)
 
     # Holiday substitution
     holiday_name = None
     holiday_text = ''
-    if os.path.exists(HOLIDAYS_FILE):
-        matches = []
-        with open(HOLIDAYS_FILE, 'r', newline='') as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                if row['Date'] == today:
-                    matches.append(row)
-
-        if matches:
-            chosen = random.choice(matches)
-            print(f"[INFO] Chosen holiday: {chosen}")
-            holiday_name = chosen["Name"]
-            holiday_text = (
-                f' It is also "{holiday_name}" ({chosen["Type"].lower()}), '
-                f'so the workplace is decorated accordingly and the goose '
-                f'is wearing a small festive accessory.'
-            )
+    matches = HOLIDAY_INDEX.get(today, [])
+    if matches:
+        chosen = matches[_rng.randrange(len(matches))]
+        logger.info("Chosen holiday: %s", chosen)
+        holiday_name = chosen["Name"]
+        holiday_text = (
+            f' It is also "{holiday_name}" ({chosen["Type"].lower()}), '
+            f'so the workplace is decorated accordingly and the goose '
+            f'is wearing a small festive accessory.'
+        )
 
     base_prompt = base_prompt.replace('{holiday}', holiday_text)
-    print(f"[INFO] Final prompt: {base_prompt}")
+    logger.info("Final prompt: %s", base_prompt)
 
-    with open(PROMPT_FILE, 'w') as f:
-        f.write(base_prompt + '\n')
+    if DEBUG:
+        with open(PROMPT_FILE, 'w') as f:
+            f.write(base_prompt + '\n')
 
     return base_prompt, holiday_name
 
-def main_loop():
+async def main_loop():
+    # Cancel the loop on SIGINT/SIGTERM so a pending sleep or request unwinds cleanly
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, main_task.cancel)
+
+    try:
+        await run_forever()
+    except asyncio.CancelledError:
+        logger.info("Shutdown requested, exiting.")
+    finally:
+        await http_client.aclose()
+
+async def run_forever():
     while True:
         # Check if we're in a 24-hour backoff period from a previous failure
         if not should_retry():
-            time.sleep(3600)
+            await asyncio.sleep(3600)
             continue
 
+        # Retries for this run must finish before the next 9 AM run
+        next_run = next_run_time(9)
+
+        await prewarm()
+
         success = False
         for attempt in range(3):
             try:
-                print(f"[INFO] Starting attempt {attempt + 1} of 3...")
+                logger.info("Starting attempt %s of 3...", attempt + 1)
 
                 image_prompt, holiday_name = generate_prompt()
-                image_bytes = generate_image(image_prompt)
+                image = (await generate_images(image_prompt))[0]
 
                 if holiday_name:
                     status_text = f"Here's a random silly goose celebrating \"{holiday_name}\" - generated by AI!\n#bird #birds #goose #geese #ai #nature"
@@ -230,34 +394,50 @@ def main_loop():
                     status_text = "Here's a random silly goose - generated by AI!\n#bird #birds #goose #geese #ai #nature"
                     email_body_text = "Here's a random silly goose - generated by AI!"
 
-                post_image_to_mastodon(image_bytes, status_text, "Here's a random silly goose - generated by AI!")
-                send_email(subject="Your Silly Goose Image", body=email_body_text, image_bytes=image_bytes, to_email=EMAIL_ADDRESS)
+                if isinstance(image, bytes):
+                    # BytesIO shares the decoded buffer with the email attachment instead of copying it
+                    image_bytes = image
+                    image_file = BytesIO(image)
+                else:
+                    # Read the attachment before handing the file to the upload thread, which consumes it
+                    image_file = image
+                    image_bytes = image_file.read()
+                    image_file.seek(0)
+
+                with image_file:
+                    # Render the email while the image uploads, but only send it once the post has gone out,
+                    # so a failed post doesn't leave an email behind for every retry
+                    email_task = asyncio.to_thread(build_email, subject="Your Silly Goose Image", body=email_body_text, image_bytes=image_bytes, to_email=EMAIL_ADDRESS)
+                    post_task = asyncio.to_thread(post_image_to_mastodon, image_file, status_text, "Here's a random silly goose - generated by AI!")
+                    msg_bytes, _ = await asyncio.gather(email_task, post_task)
+                    await send_email(msg_bytes, to_email=EMAIL_ADDRESS)
 
                 success = True
                 break
 
             except Exception as e:
-                print(f"[ERROR] Attempt {attempt + 1} failed: {e}")
+                logger.error("Attempt %s failed: %s", attempt + 1, e)
                 if attempt < 2:
                     # Wait 10 minutes before retrying, unless 9 AM is sooner
-                    seconds_until_9am = time_until_next_run(9)
-                    wait = min(600, seconds_until_9am)
+                    wait = min(600, seconds_until(next_run))
                     if wait <= 0:
                         # No time left in this run window, give up for today
-                        print("[INFO] No time left before next run window, giving up.")
+                        logger.info("No time left before next run window, giving up.")
                         break
-                    print(f"[INFO] Retrying in {wait} seconds...")
-                    time.sleep(wait)
+                    logger.info("Retrying in %s seconds...", wait)
+                    await asyncio.sleep(wait)
 
         if not success:
             # All 3 attempts failed, record error to trigger 24-hour backoff
-            print("[INFO] All attempts failed. Recording error and backing off 24 hours.")
+            logger.info("All attempts failed. Recording error and backing off 24 hours.")
             record_error()
 
-        # Wait until 9 AM for the next daily run
-        seconds_until_9am = time_until_next_run(9)
-        print(f"[INFO] Waiting until 9 AM. Sleeping for {seconds_until_9am} seconds...")
-        time.sleep(seconds_until_9am)
+        # Wait until 9 AM for the next daily run, waking hourly to re-check the clock
+        # so a suspend/resume doesn't make us oversleep the target
+        next_run = next_run_time(9)
+        logger.info("Waiting until 9 AM. Sleeping for %s seconds...", seconds_until(next_run))
+        while (remaining := seconds_until(next_run)) > 0:
+            await asyncio.sleep(min(remaining, 3600))
 
 if __name__ == "__main__":
-    main_loop()
+    asyncio.run(main_loop())